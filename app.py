@@ -1,11 +1,27 @@
-from flask import Flask, request, jsonify, render_template
+from flask import Flask, Response, request, jsonify, render_template
 import csv
-from io import StringIO
-from typing import Any, List, Dict, Set, Optional
+import heapq
+import logging
+import re
+import sys
+import threading
+from io import TextIOWrapper
+from typing import Iterable, List, Dict, Optional, Set, Tuple
 import json
+import orjson
+from collections import OrderedDict, defaultdict
+from itertools import islice
+from operator import itemgetter
+from pyroaring import BitMap, FrozenBitMap
+from sortedcontainers import SortedList
+
+_TOKEN_RE = re.compile(r"\w+")
+
 
 # Search Engine implementation
 class Document:
+    __slots__ = ("doc_id", "content", "meta_data")
+
     def __init__(self, doc_id: int, content: str, metaData: Dict[str, str]) -> None:
         self.doc_id = doc_id
         self.content = content.lower()
@@ -17,35 +33,103 @@ class Document:
 
 class InvertedIndex:
     def __init__(self) -> None:
-        self.index: Dict[str, Set[int]] = {}
+        self.index: Dict[str, BitMap] = {}
 
     def addDocument(self, doc_id: int, content: str):
-        words = content.lower().split()
-        for word in words:
-            if word not in self.index:
-                self.index[word] = set()
-            self.index[word].add(doc_id)
-
-    def search(self, search_words: List[str]) -> Set[int]:
+        words = _TOKEN_RE.findall(content)
+        index = self.index
+        for word in set(words):
+            posting = index.get(word)
+            if posting is None:
+                posting = index[sys.intern(word)] = BitMap()
+            posting.add(doc_id)
+
+    def addDocumentsBulk(self, documents: Iterable[Tuple[int, str]]):
+        word_doc_ids: Dict[str, List[int]] = defaultdict(list)
+        for doc_id, content in documents:
+            for word in set(_TOKEN_RE.findall(content)):
+                word_doc_ids[word].append(doc_id)
+        index = self.index
+        for word, doc_ids in word_doc_ids.items():
+            posting = index.get(word)
+            if posting is None:
+                posting = index[sys.intern(word)] = BitMap()
+            posting.update(doc_ids)
+
+    def freeze(self):
+        for posting in self.index.values():
+            posting.run_optimize()
+            posting.shrink_to_fit()
+
+    def search(self, search_words: List[str]) -> BitMap:
         if not search_words:
-            return set()
-        result_set = self.index.get(search_words[0], set()).copy()
-        for word in search_words[1:]:
-            result_set.intersection_update(self.index.get(word, set()))
-        return result_set
+            return BitMap()
+        postings = []
+        for word in search_words:
+            posting = self.index.get(word)
+            if posting is None:
+                return BitMap()
+            postings.append(posting)
+        postings.sort(key=len)
+        return postings[0].intersection(*postings[1:])
+
+
+SORT_INDEX_LIMIT = 8
 
 
 class Dataset:
     def __init__(self) -> None:
         self.documents: Dict[int, Document] = {}
         self.inverted_index = InvertedIndex()
+        self.meta_keys: Set[str] = set()
+        self.sort_indexes: OrderedDict[str, SortedList] = OrderedDict()
+        self.next_doc_id = 1
+        self._lock = threading.Lock()
+        self.version = 0
 
     def addDocument(self, doc_id: int, document: Document):
-        self.documents[doc_id] = document
-        self.inverted_index.addDocument(doc_id, document.content)
+        with self._lock:
+            self.documents[doc_id] = document
+            self.inverted_index.addDocument(doc_id, document.content)
+            self.meta_keys.update(document.meta_data)
+            for key, sort_index in self.sort_indexes.items():
+                sort_index.add((document.meta_data.get(key, ""), doc_id))
+            self.version += 1
+
+    def addDocumentsBulk(self, documents: List[Document]):
+        with self._lock:
+            for document in documents:
+                self.documents[document.doc_id] = document
+                self.meta_keys.update(document.meta_data)
+            self.inverted_index.addDocumentsBulk((document.doc_id, document.content) for document in documents)
+            for key, sort_index in self.sort_indexes.items():
+                sort_index.update((document.meta_data.get(key, ""), document.doc_id) for document in documents)
+            self.version += 1
+
+    def reserve_doc_ids(self, count: int = 1) -> int:
+        first_doc_id = self.next_doc_id
+        self.next_doc_id += count
+        return first_doc_id
 
     def gte_document_by_id(self, doc_id: int) -> Document:
         return self.documents[doc_id]
+
+    def sorted_doc_ids(self, key: str, doc_ids: FrozenBitMap, limit: Optional[int] = None) -> Optional[List[int]]:
+        with self._lock:
+            if key not in self.meta_keys:
+                return None
+
+            sort_index = self.sort_indexes.get(key)
+            if sort_index is None:
+                sort_index = self.sort_indexes[key] = SortedList(
+                    (document.meta_data.get(key, ""), doc_id) for doc_id, document in self.documents.items())
+                while len(self.sort_indexes) > SORT_INDEX_LIMIT:
+                    self.sort_indexes.popitem(last=False)
+            else:
+                self.sort_indexes.move_to_end(key)
+
+            matching = (doc_id for _, doc_id in sort_index if doc_id in doc_ids)
+            return list(islice(matching, limit))
     
 
 
@@ -54,36 +138,50 @@ class DatasetFactory:
         return Dataset()
 
 
+SORT_INDEX_MIN_SHARE = 8
+
+
 class SortStrategy:
-    def sort(self, results: List['SearchResult'], key: str) -> List['SearchResult']:
+    __slots__ = ()
+
+    def sort(self, dataset: Dataset, doc_ids: FrozenBitMap, key: str, limit: Optional[int] = None) -> List[Document]:
         raise NotImplementedError("Sort strategy must implement sort method")
 
 
 class KeySortStrategy(SortStrategy):
-    def sort(self, results: List['SearchResult'], inp_key: str) -> List['SearchResult']:
-        return sorted(results, key=lambda x: x.document.get_key_value(inp_key))
-
-
-class SearchResult:
-    def __init__(self, document: Document) -> None:
-        self.document = document
+    __slots__ = ()
+
+    def sort(self, dataset: Dataset, doc_ids: FrozenBitMap, inp_key: str, limit: Optional[int] = None) -> List[Document]:
+        sorted_ids = None
+        if limit is not None and len(doc_ids) * SORT_INDEX_MIN_SHARE >= len(dataset.documents):
+            sorted_ids = dataset.sorted_doc_ids(inp_key, doc_ids, limit)
+        if sorted_ids is not None:
+            return [dataset.gte_document_by_id(doc_id) for doc_id in sorted_ids]
+
+        documents = dataset.documents
+        decorated = [(documents[doc_id].meta_data.get(inp_key, ""), doc_id) for doc_id in doc_ids]
+        if limit is not None:
+            decorated = heapq.nsmallest(limit, decorated, key=itemgetter(0))
+        else:
+            decorated.sort(key=itemgetter(0))
+        return [dataset.gte_document_by_id(doc_id) for _, doc_id in decorated]
 
 
-class SingletonMeta(type):
-    _instances = {}
+QUERY_CACHE_SIZE = 1024
 
-    def __call__(cls, *args: Any, **kwds: Any):
-        if cls not in cls._instances:
-            instance = super().__call__(*args, **kwds)
-            cls._instances[cls] = instance
-        return cls._instances[cls]
 
+class SearchEngine:
+    def __new__(cls) -> 'SearchEngine':
+        instance = cls.__dict__.get("_instance")
+        if instance is None:
+            instance = cls._instance = super().__new__(cls)
+            instance._setup()
+        return instance
 
-class SearchEngine(metaclass=SingletonMeta):
-    def __init__(self) -> None:
+    def _setup(self) -> None:
         self.datasets: Dict[str, Dataset] = {}
         self.sort_strategy: SortStrategy = KeySortStrategy()
-        self.next_doc_id = 1
+        self._query_cache: OrderedDict[tuple, FrozenBitMap] = OrderedDict()
 
     def create_dataset(self, name: str):
         if name not in self.datasets:
@@ -92,27 +190,54 @@ class SearchEngine(metaclass=SingletonMeta):
 
     def insert_document(self, dataset_name: str, content: str, metaData: Dict[str, str]):
         if dataset_name in self.datasets:
-            doc = Document(self.next_doc_id, content, metaData)
-            self.datasets[dataset_name].addDocument(self.next_doc_id, doc)
-            self.next_doc_id += 1
+            dataset = self.datasets[dataset_name]
+            doc_id = dataset.reserve_doc_ids()
+            dataset.addDocument(doc_id, Document(doc_id, content, metaData))
         else:
             raise ValueError(f"Dataset '{dataset_name}' does not exist.")
 
-    def search(self, dataset_name: str, search_patterns: str, order_by_key: Optional[str]):
+    def insert_documents_bulk(self, dataset_name: str, documents: List[Tuple[str, Dict[str, str]]]):
+        if dataset_name not in self.datasets:
+            raise ValueError(f"Dataset '{dataset_name}' does not exist.")
+
+        dataset = self.datasets[dataset_name]
+        first_doc_id = dataset.reserve_doc_ids(len(documents))
+
+        docs = [Document(doc_id, content, metaData) for doc_id, (content, metaData) in enumerate(documents, first_doc_id)]
+        dataset.addDocumentsBulk(docs)
+
+    def freeze_dataset(self, dataset_name: str):
+        if dataset_name not in self.datasets:
+            raise ValueError(f"Dataset '{dataset_name}' does not exist.")
+        self.datasets[dataset_name].inverted_index.freeze()
+
+    def search(self, dataset_name: str, search_patterns: str, order_by_key: Optional[str], limit: Optional[int] = None):
         if dataset_name not in self.datasets:
             raise ValueError(f"Dataset '{dataset_name}' does not exist.")
 
-        search_words = search_patterns.lower().split()
+        search_words = [sys.intern(word) for word in _TOKEN_RE.findall(search_patterns.lower())]
         dataset = self.datasets[dataset_name]
 
-        matching_doc_ids = dataset.inverted_index.search(search_words)
-        results = [SearchResult(dataset.gte_document_by_id(doc_id)) for doc_id in matching_doc_ids]
+        cache_key = (dataset_name, dataset.version, tuple(sorted(set(search_words))))
+        matching_doc_ids = self._query_cache.pop(cache_key, None)
+        if matching_doc_ids is None:
+            matching_doc_ids = FrozenBitMap(dataset.inverted_index.search(search_words))
+        self._query_cache[cache_key] = matching_doc_ids
+        if len(self._query_cache) > QUERY_CACHE_SIZE:
+            try:
+                self._query_cache.popitem(last=False)
+            except KeyError:
+                pass
 
         if order_by_key:
-            results = self.sort_strategy.sort(results, order_by_key)
+            return self.sort_strategy.sort(dataset, matching_doc_ids, order_by_key, limit)
+
+        return [dataset.gte_document_by_id(doc_id) for doc_id in islice(matching_doc_ids, limit)]
 
-        return results
 
+BULK_BATCH_SIZE = 1000
+
+log = logging.getLogger(__name__)
 
 app = Flask(__name__)
 
@@ -162,18 +287,17 @@ def upload_bulk_documents():
     
     file = request.files['file']
 
-    print(file.filename)
     if not dataset_name:
         return jsonify({'error': 'Dataset name is required'}), 400
     else:
         search_engine.create_dataset(dataset_name)
-        print(f"{dataset_name} dataset creation successful")
+        log.debug("Bulk upload of '%s' into dataset '%s'", file.filename, dataset_name)
 
     try:
-        stream = StringIO(file.stream.read().decode("UTF8"), newline=None)
+        stream = TextIOWrapper(file.stream, encoding="utf-8", newline="")
         csv_reader = csv.reader(stream)
-        print(csv_reader)
 
+        documents = []
 
         # Process each row
         for row in csv_reader:
@@ -187,19 +311,17 @@ def upload_bulk_documents():
             if not content.strip():
                 continue
 
-            str_test = "{"
-            for index, item1 in enumerate(metadata_str.split(',')):
-                if ':' in item1:
-                    key, value = item1.split(':', 1)  # Splitting into key and value
-                    str_test += f'"{key.strip()}": "{value.strip()}"'
-                    if index < len(metadata_str.split(',')) - 1:
-                        str_test += ', '
-                else:
-                    print(f"Skipping invalid item: {item1}")
-            str_test += '}'
-            print(str_test)
-            search_engine.insert_document(dataset_name, content, str_test)
-
+            # key:value pairs, items without a ':' are skipped
+            items = [item.split(':', 1) for item in metadata_str.split(',') if ':' in item]
+            meta_data_dict = {key.strip(): value.strip() for key, value in items}
+            documents.append((content, meta_data_dict))
+            if len(documents) >= BULK_BATCH_SIZE:
+                search_engine.insert_documents_bulk(dataset_name, documents)
+                documents = []
+
+        if documents:
+            search_engine.insert_documents_bulk(dataset_name, documents)
+        search_engine.freeze_dataset(dataset_name)
         return jsonify({'message': 'Bulk documents uploaded successfully!'}), 200
 
 
@@ -211,19 +333,29 @@ def search():
     dataset_name = request.args.get('dataset_name')
     search_patterns = request.args.get('search_patterns')
     order_by_key = request.args.get('order_by_key')
-    print(order_by_key)
+    limit_arg = request.args.get('limit', '').strip()
     
     if not dataset_name or dataset_name not in search_engine.datasets:
         return jsonify({'error': 'Dataset does not exist'}), 400
+
+    # an empty limit (the blank form field) means no limit, anything else must be a positive integer
+    limit = None
+    if limit_arg:
+        try:
+            limit = int(limit_arg)
+        except ValueError:
+            return jsonify({'error': 'Limit must be a positive integer'}), 400
+        if limit < 1:
+            return jsonify({'error': 'Limit must be a positive integer'}), 400
     
     # temp = search_engine.datasets
     # for item in temp:
     #     print(item)
     
     try:
-        results = search_engine.search(dataset_name, search_patterns, order_by_key)
-        response = [{'content': result.document.content, 'metadata': result.document.meta_data} for result in results]
-        return jsonify({'results': response}), 200
+        results = search_engine.search(dataset_name, search_patterns, order_by_key, limit)
+        response = orjson.dumps({'results': [{'content': result.content, 'metadata': result.meta_data} for result in results]})
+        return Response(response, status=200, mimetype='application/json')
     except Exception as e:
         return jsonify({'error': str(e)}), 500
     
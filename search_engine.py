@@ -1,8 +1,22 @@
-from typing import Any, List, Dict, Set, Optional
+import heapq
+import re
+import sys
+import threading
+from typing import Iterable, List, Dict, Optional, Set, Tuple
+from collections import OrderedDict, defaultdict
+from itertools import islice
+from operator import itemgetter
+from pyroaring import BitMap, FrozenBitMap
+from sortedcontainers import SortedList
 
 
 
+_TOKEN_RE = re.compile(r"\w+")  # words without the punctuation around them
+
+
 class Document:
+    __slots__ = ("doc_id", "content", "meta_data")
+
     def __init__(self, doc_id : int, content : str, metaData : Dict[str, str]) -> None:
         self.doc_id = doc_id 
         self.content = content.lower()  # Converting to lower for case-insensitive 
@@ -20,42 +34,119 @@ class Document:
 #-------------Search method implementation
 class InvertedIndex:
     def __init__(self) -> None:
-        self.index : Dict [str, Set[int]] = {}
+        self.index : Dict [str, BitMap] = {}
     
     def addDocument (self, doc_id : int, content : str):
-        # split the word to insert in index 
-        words = content.lower().split()
-        for word in words:
-            if word not in self.index:
-                self.index[word] = set()  # Single word can be present in multiple documents
-            self.index[word].add(doc_id)
+        # split the word to insert in index, content is already lower case
+        words = _TOKEN_RE.findall(content)
+        index = self.index
+        for word in set(words):  # each (word, doc) pair touches the index once
+            posting = index.get(word)
+            if posting is None:
+                posting = index[sys.intern(word)] = BitMap()  # Single word can be present in multiple documents
+            posting.add(doc_id)
+
+    def addDocumentsBulk (self, documents : Iterable[Tuple[int, str]]):
+        # group doc ids by word first, so each posting list is updated once per batch
+        word_doc_ids : Dict[str, List[int]] = defaultdict(list)
+        for doc_id, content in documents:
+            for word in set(_TOKEN_RE.findall(content)):
+                word_doc_ids[word].append(doc_id)
+
+        index = self.index
+        for word, doc_ids in word_doc_ids.items():
+            posting = index.get(word)
+            if posting is None:
+                posting = index[sys.intern(word)] = BitMap()
+            posting.update(doc_ids)
+
+    def freeze (self):
+        # once ingest settles, compact every posting list: runs of consecutive ids become
+        # run containers and spare capacity is released, the bitmaps stay writable
+        for posting in self.index.values():
+            posting.run_optimize()
+            posting.shrink_to_fit()
    
-    def search(self, search_words : List[str]) -> Set[int]:
+    def search(self, search_words : List[str]) -> BitMap:
         # check search words 
         if not search_words:
-            return set()
-        # set of documents containing the first word
-        result_set = self.index.get(search_words[0], set()).copy()
+            return BitMap()
+        # posting list of every word, stop at the first missing word since then no document can match
+        postings = []
+        for word in search_words:
+            posting = self.index.get(word)
+            if posting is None:
+                return BitMap()
+            postings.append(posting)
 
-        # intersect with the set of documents containing the rest of the words
-        for word in search_words[1:]:
-            result_set.intersection_update(self.index.get(word, set()))
-        
-        return result_set
+        # smallest posting list first, so it drives the intersection
+        postings.sort(key = len)
+
+        # a single call into CRoaring's compiled intersection, no Python loop per word
+        return postings[0].intersection(*postings[1:])
 
 #------------Dataset --------------
 
+SORT_INDEX_LIMIT = 8  # sort indexes kept per dataset, least recently used is dropped first
+
 class Dataset:
     def __init__(self) -> None:
         self.documents : Dict[int, Document] = {}
         self.inverted_index = InvertedIndex()
+        self.meta_keys : Set[str] = set()  # every metadata key seen in this dataset
+        self.sort_indexes : OrderedDict[str, SortedList] = OrderedDict() # metadata key , sorted (value, doc_id) pairs
+        self.next_doc_id = 1  # ids are allocated per dataset, so they stay dense in its bitmaps
+        self._lock = threading.Lock()  # inserts and sort index builds / walks never interleave
+        self.version = 0  # bumped after every insert, part of the query cache key
     
     def addDocument(self, doc_id: int, document : Document):
-        self.documents[doc_id] = document
-        self.inverted_index.addDocument(doc_id, document.content)
+        with self._lock:
+            self.documents[doc_id] = document
+            self.inverted_index.addDocument(doc_id, document.content)
+            self.meta_keys.update(document.meta_data)
+            for key, sort_index in self.sort_indexes.items():
+                sort_index.add((document.meta_data.get(key, ""), doc_id))
+            self.version += 1
+
+    def addDocumentsBulk(self, documents : List[Document]):
+        with self._lock:
+            for document in documents:
+                self.documents[document.doc_id] = document
+                self.meta_keys.update(document.meta_data)
+            self.inverted_index.addDocumentsBulk((document.doc_id, document.content) for document in documents)
+            for key, sort_index in self.sort_indexes.items():
+                sort_index.update((document.meta_data.get(key, ""), document.doc_id) for document in documents)
+            self.version += 1
     
+    def reserve_doc_ids (self, count : int = 1) -> int:
+        # returns the first of `count` consecutive fresh doc ids
+        first_doc_id = self.next_doc_id
+        self.next_doc_id += count
+        return first_doc_id
+
     def gte_document_by_id (self, doc_id : int) -> Document:
         return self.documents[doc_id]
+
+    def sorted_doc_ids (self, key : str, doc_ids : FrozenBitMap, limit : Optional[int] = None) -> Optional[List[int]]:
+        # doc_ids in key order using the sort index, None when there is no index for the key
+        with self._lock:
+            # only keys some document actually has get an index, anything else can't be ordered by it
+            if key not in self.meta_keys:
+                return None
+
+            sort_index = self.sort_indexes.get(key)
+            if sort_index is None:
+                # built on the first query ordered by this key, then kept up to date on insert
+                sort_index = self.sort_indexes[key] = SortedList(
+                    (document.meta_data.get(key, ""), doc_id) for doc_id, document in self.documents.items())
+                while len(self.sort_indexes) > SORT_INDEX_LIMIT:
+                    self.sort_indexes.popitem(last = False)
+            else:
+                self.sort_indexes.move_to_end(key)
+
+            # walk the index in key order and keep the matches
+            matching = (doc_id for _, doc_id in sort_index if doc_id in doc_ids)
+            return list(islice(matching, limit))
     
 
 # Factory Design Pattern 
@@ -65,43 +156,53 @@ class DatasetFactory:
 
 #------------ Sorting  --------------
 
+SORT_INDEX_MIN_SHARE = 8  # limited queries walk the sort index once results are at least 1/8 of the dataset
+
 # Strategy Pattern 
 class SortStrategy:
-    def sort (self, results: List['SearchResult'], key : str) -> List['SearchResult']:
+    __slots__ = ()
+
+    def sort (self, dataset : Dataset, doc_ids : FrozenBitMap, key : str, limit : Optional[int] = None) -> List[Document]:
         raise NotImplementedError("Sort strategy must  implemented sort method")
 
 class KeySortStrategy(SortStrategy):
-    def sort(self, results: List['SearchResult'], inp_key: str) -> List['SearchResult']:
-        # print(results[0].document.get_key_value(inp_key))
-        print(results[0].document)
-        return sorted(results, key = lambda x : x.document.get_key_value(inp_key))
+    __slots__ = ()
 
+    def sort(self, dataset : Dataset, doc_ids : FrozenBitMap, inp_key: str, limit : Optional[int] = None) -> List[Document]:
+        sorted_ids = None
+        if limit is not None and len(doc_ids) * SORT_INDEX_MIN_SHARE >= len(dataset.documents):
+            # large result with a limit, walk the presorted index and stop after `limit` matches,
+            # without a limit the full walk is slower than sorting the hits
+            sorted_ids = dataset.sorted_doc_ids(inp_key, doc_ids, limit)
+        if sorted_ids is not None:
+            return [dataset.gte_document_by_id(doc_id) for doc_id in sorted_ids]
 
+        # decorate the ids with their key once, sort, then fetch only the documents that survive
+        documents = dataset.documents
+        decorated = [(documents[doc_id].meta_data.get(inp_key, ""), doc_id) for doc_id in doc_ids]
+        if limit is not None:
+            # top-k selection, O(N log K) instead of sorting everything
+            decorated = heapq.nsmallest(limit, decorated, key = itemgetter(0))
+        else:
+            decorated.sort(key = itemgetter(0))
+        return [dataset.gte_document_by_id(doc_id) for _, doc_id in decorated]
 
-class SearchResult:
-    def __init__(self, document : Document ) -> None:
-        self.document = document
-    
-    # def __str__(self) -> str:
-    #     return f"{self.document.content}"
-
-class SingletonMeta(type):
-    _instances = {}
-    
-    def __call__(cls, *args: Any, **kwds: Any) :
-        if cls not in cls._instances:
-            instance = super().__call__(*args, **kwds)
-            cls._instances[cls] = instance
-        
-        return cls._instances[cls]
 
+QUERY_CACHE_SIZE = 1024  # distinct queries kept in the LRU cache
 
+# Singleton Pattern, the instance is cached on the class itself
+class SearchEngine:
+    def __new__(cls) -> 'SearchEngine':
+        instance = cls.__dict__.get("_instance")
+        if instance is None:
+            instance = cls._instance = super().__new__(cls)
+            instance._setup()  # state is built once, not on every SearchEngine() call
+        return instance
 
-class SearchEngine(metaclass = SingletonMeta):
-    def __init__(self) -> None:
+    def _setup(self) -> None:
         self.datasets : Dict [str, Dataset] = {} # name , dataset
         self.sort_strategy : SortStrategy = KeySortStrategy()
-        self.next_doc_id = 1 
+        self._query_cache : OrderedDict[tuple, FrozenBitMap] = OrderedDict() # (dataset name, version, words) , matching doc ids
     
     def create_dataset(self, name : str):
         if name not in self.datasets:
@@ -110,30 +211,59 @@ class SearchEngine(metaclass = SingletonMeta):
         
     def insert_document(self, dataset_name : str, content : str, metaData : Dict[str, str]):
         if dataset_name in self.datasets:
-            doc = Document(self.next_doc_id, content, metaData)
-            self.datasets[dataset_name].addDocument(self.next_doc_id, doc)
-            self.next_doc_id +=1
+            dataset = self.datasets[dataset_name]
+            doc_id = dataset.reserve_doc_ids()
+            dataset.addDocument(doc_id, Document(doc_id, content, metaData))
         else :
             raise ValueError(f"Dataset '{dataset_name} does not exists.")
 
-    def search(self, dataset_name, search_pattens, order_by_key : Optional[str] ):
+    def insert_documents_bulk(self, dataset_name : str, documents : List[Tuple[str, Dict[str, str]]]):
+        if dataset_name not in self.datasets:
+            raise ValueError(f"Dataset '{dataset_name} does not exists.")
+
+        # reserve the doc ids for the whole batch in one shot
+        dataset = self.datasets[dataset_name]
+        first_doc_id = dataset.reserve_doc_ids(len(documents))
+
+        docs = [Document(doc_id, content, metaData) for doc_id, (content, metaData) in enumerate(documents, first_doc_id)]
+        dataset.addDocumentsBulk(docs)
+
+    def freeze_dataset(self, dataset_name : str):
+        if dataset_name not in self.datasets:
+            raise ValueError(f"Dataset '{dataset_name} does not exists.")
+        self.datasets[dataset_name].inverted_index.freeze()
+
+    def search(self, dataset_name, search_pattens, order_by_key : Optional[str], limit : Optional[int] = None):
         if dataset_name not in self.datasets:
             raise ValueError(f"Dataset '{dataset_name} does not exists.")
         
-        search_words = search_pattens.lower().split()
+        # interned words match the interned index keys by identity
+        search_words = [sys.intern(word) for word in _TOKEN_RE.findall(search_pattens.lower())]
         dataset = self.datasets[dataset_name]
 
-        matching_doc_ids = dataset.inverted_index.search(search_words)
-        print(matching_doc_ids)
+        # word order and repeats don't change an AND query, so they share a cache entry.
+        # The version is read before searching: a result computed while an insert lands is
+        # stored under the old version, which no later query asks for.
+        cache_key = (dataset_name, dataset.version, tuple(sorted(set(search_words))))
+        # pop and re-insert instead of get + move_to_end, another search may evict in between
+        matching_doc_ids = self._query_cache.pop(cache_key, None)
+        if matching_doc_ids is None:
+            matching_doc_ids = FrozenBitMap(dataset.inverted_index.search(search_words))
+        self._query_cache[cache_key] = matching_doc_ids  # most recently used
+        if len(self._query_cache) > QUERY_CACHE_SIZE:
+            try:
+                self._query_cache.popitem(last = False)
+            except KeyError:
+                pass  # emptied by concurrent evictions, nothing left to evict
+
+        if order_by_key:
+            return self.sort_strategy.sort(dataset, matching_doc_ids, order_by_key, limit)
 
         results = []
 
-        for doc_id in matching_doc_ids:
-            document = dataset.gte_document_by_id(doc_id)
-            results.append(SearchResult(document))
-        
-        # if order_by_key:
-        #     results = self.sort_strategy.sort(results, order_by_key)
+        # without an order only the first `limit` documents are needed
+        for doc_id in islice(matching_doc_ids, limit):
+            results.append(dataset.gte_document_by_id(doc_id))
         
         return results
         
@@ -155,4 +285,4 @@ if __name__ == "__main__":
 
     results1 = search_engine.search("blogs","content", order_by_key="date")
     for result in results1:
-        print(result.document.doc_id)
+        print(result.doc_id)